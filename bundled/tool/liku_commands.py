@@ -1,5 +1,16 @@
-from typing import cast
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Hashable
+from functools import lru_cache
+from typing import Any, Callable, TypeVar
+import contextlib
+import hashlib
+import importlib.util
+import os
+import pickle
+import sys
 import typing
+import platformdirs
 from jedi.api import Script
 from liku_parser import (
     SuggestComponent,
@@ -7,99 +18,278 @@ from liku_parser import (
     SuggestPython,
 )
 from lsprotocol.types import CompletionItem, CompletionItemKind
+import liku
 from liku import __all__ as liku_elements
-from liku.elements import h as h_func
 
-mapping: dict[str, dict[str, type]] = {}
-for overload in typing.get_overloads(h_func):
-    hints = typing.get_type_hints(overload)
-    tag_name = typing.get_args(hints["tag_name"])[0]
-    if tag_name not in liku_elements:
-        continue
 
-    prop_types = typing.get_args(hints["props"])[0]
-    assert typing.is_typeddict(prop_types), "Unexpected non-typeddict"
-    mapping[tag_name] = typing.get_type_hints(prop_types)
+@lru_cache(maxsize=None)
+def _prop_type_hints(prop_types: type) -> dict[str, type]:
+    # Several overloads can share the same props TypedDict.
+    return typing.get_type_hints(prop_types)
 
 
-def suggest_components(script: Script, action: SuggestComponent):
-    search_text = action.cursor
-    is_closing_tag = search_text.startswith("/")
-    if is_closing_tag:
-        search_text = search_text[1:]
+def _build_mapping() -> dict[str, dict[str, type]]:
+    # NOTE: Imported here so liku.elements is only loaded when we have to
+    #       reflect on it.
+    from liku.elements import h as h_func
 
-    candidates = list(
-        map(
-            lambda x: cast(str, x.name),
-            filter(
-                lambda x: x.type in ("function", "class"),
-                script.complete_search(search_text),
-            ),
-        )
-    )
-    candidates.extend(filter(lambda x: x.startswith(search_text), liku_elements))
-
-    completions = map(
-        lambda x: CompletionItem(
-            label=x,
-            insert_text=((f"{x}></" if not is_closing_tag else "") + f"{x}>"),
-        ),
-        candidates,
+    mapping: dict[str, dict[str, type]] = {}
+    for overload in typing.get_overloads(h_func):
+        hints = typing.get_type_hints(overload)
+        tag_name = typing.get_args(hints["tag_name"])[0]
+        if tag_name not in liku_elements:
+            continue
+
+        prop_types = typing.get_args(hints["props"])[0]
+        assert typing.is_typeddict(prop_types), "Unexpected non-typeddict"
+        mapping[tag_name] = _prop_type_hints(prop_types)
+    return mapping
+
+
+def _liku_elements_path() -> str:
+    spec = importlib.util.find_spec("liku.elements")
+    assert spec and spec.origin, "Cannot locate liku.elements"
+    return spec.origin
+
+
+def _liku_elements_digest() -> str:
+    with open(_liku_elements_path(), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _mapping_cache_path() -> str:
+    version = getattr(liku, "__version__", "unknown")
+    mtime = int(os.path.getmtime(_liku_elements_path()))
+    # Servers of different interpreters share the cache dir.
+    python = "{}.{}".format(*sys.version_info[:2])
+    return os.path.join(
+        platformdirs.user_cache_dir("liku-lsp"),
+        f"props-{version}-{mtime}-py{python}.pkl",
     )
 
-    return list(completions)
 
+def _load_mapping() -> dict[str, tuple[str, ...]]:
+    cache_path = _mapping_cache_path()
+    try:
+        with open(cache_path, "rb") as f:
+            props = pickle.load(f)
+        if isinstance(props, dict) and all(
+            isinstance(names, tuple) and all(isinstance(name, str) for name in names)
+            for names in props.values()
+        ):
+            return props
+    except Exception:  # pylint: disable=broad-except
+        # NOTE: The file outlives the server, anything can be in it. Reflect
+        #       again and overwrite it.
+        pass
 
-def _suggest_from_liku(component: str, search_text: str) -> list[str]:
-    if component not in liku_elements:
-        return []
+    props = {tag: tuple(sorted(hints)) for tag, hints in _build_mapping().items()}
+    # Write to a temporary file first so concurrent servers never read a
+    # half-written cache.
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            pickle.dump(props, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # NOTE: Failing to cache is fine, we just reflect again next start.
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+    return props
 
-    props = mapping[component]
-    return list(filter(lambda x: x.startswith(search_text), props.keys()))
 
+def _load_prop_names() -> dict[str, tuple[str, ...]]:
+    # The registry is generated by tools/gen_liku_mapping.py when packaging,
+    # it is only valid for the liku it was generated from.
+    try:
+        from _liku_tag_props import LIKU_ELEMENTS_DIGEST, PROPS
 
-def _suggest_from_custom_component(script: Script, component: str, search_text: str):
-    search_result = list(script.search(component))
-    if len(search_result) == 0:
-        # NOTE: wtf?
-        return []
+        if LIKU_ELEMENTS_DIGEST == _liku_elements_digest():
+            return PROPS
+    except ImportError:
+        pass
 
-    func = search_result[0]
-    names: list[str] = []
+    return _load_mapping()
+
+
+# Sorted so prefix lookups can bisect instead of scanning every name.
+_SORTED_ELEMENTS = tuple(sorted(liku_elements))
+_SORTED_PROPS = _load_prop_names()
+
+
+def _with_prefix(names: tuple[str, ...], prefix: str) -> tuple[str, ...]:
+    lo = bisect_left(names, prefix)
+    hi = bisect_left(names, prefix + "\U0010ffff", lo)
+    return names[lo:hi]
+
+
+# Results derived from jedi, keyed on a source key provided by the caller which
+# must change whenever the source does. Only plain data is kept: jedi's own
+# names hold on to the inference state and parse tree of their Script.
+_JEDI_CACHE: OrderedDict[Hashable, Any] = OrderedDict()
+_JEDI_CACHE_SIZE = 128
+
+T = TypeVar("T")
+
+
+def _cached(key: Hashable | None, compute: Callable[[], T]) -> T:
+    if key is None:
+        return compute()
+
+    try:
+        value = _JEDI_CACHE[key]
+    except KeyError:
+        value = _JEDI_CACHE[key] = compute()
+        if len(_JEDI_CACHE) > _JEDI_CACHE_SIZE:
+            _JEDI_CACHE.popitem(last=False)
+    else:
+        _JEDI_CACHE.move_to_end(key)
+    return value
+
+
+def forget_document(uri: str) -> None:
+    """Drops the cached results of every version of document `uri`."""
+    # Clients reopen a closed document at version 1 again, which would hit
+    # the (uri, version) keys of its old source.
+    for key in [key for key in _JEDI_CACHE if key[0][0] == uri]:
+        del _JEDI_CACHE[key]
+
+
+def _cached_search(
+    get_script: Callable[[], Script],
+    source_key: Hashable | None,
+    query: str,
+    all_scopes: bool = False,
+) -> list[tuple[str, str]]:
+    """Returns the (name, type) of jedi's completions for `query`."""
+
+    def run():
+        if (names := _complete_from_prefix(source_key, query, all_scopes)) is not None:
+            return names
+        return [
+            (completion.name, completion.type)
+            for completion in get_script().complete_search(query, all_scopes=all_scopes)
+        ]
+
+    key = None
+    if source_key is not None:
+        key = (source_key, "search", query, all_scopes)
+    return _cached(key, run)
 
-    for sig in func.get_signatures():
-        if len(sig.params) == 0:
+
+def _complete_from_prefix(
+    source_key: Hashable | None, query: str, all_scopes: bool
+) -> list[tuple[str, str]] | None:
+    # Jedi completes the last dotted part of the query case-insensitively, so
+    # for a plain name the completions of any prefix of it can be filtered
+    # down instead of searching again.
+    if source_key is None or not (query == "" or query.isidentifier()):
+        return None
+
+    wanted = query.lower()
+    best_query: str | None = None
+    best_names: list[tuple[str, str]] = []
+    for key, names in _JEDI_CACHE.items():
+        if key[:2] != (source_key, "search") or key[3] != all_scopes:
+            continue
+
+        cached_query = key[2]
+        if not (cached_query == "" or cached_query.isidentifier()):
             continue
 
-        for param in filter(
-            lambda param: param.name and param.name.startswith(search_text),
-            sig.params,
+        if wanted.startswith(cached_query.lower()) and (
+            best_query is None or len(cached_query) > len(best_query)
         ):
-            names.append(param.name)
-    return names
+            best_query, best_names = cached_query, names
+
+    if best_query is None:
+        return None
+    return [name for name in best_names if name[0].lower().startswith(wanted)]
+
+
+def _signature_params(
+    get_script: Callable[[], Script], source_key: Hashable | None, component: str
+) -> list[list[str]]:
+    def run():
+        search_result = get_script().search(component)
+        if len(search_result) == 0:
+            # NOTE: wtf?
+            return []
 
+        return [
+            [param.name for param in sig.params]
+            for sig in search_result[0].get_signatures()
+        ]
 
-def suggest_props(script: Script, action: SuggestProps):
+    key = None
+    if source_key is not None:
+        key = (source_key, "signatures", component)
+    return _cached(key, run)
+
+
+# Jedi name types which can be used as a component.
+_COMPONENT_TYPES = frozenset(("function", "class"))
+
+
+def suggest_components(
+    get_script: Callable[[], Script],
+    action: SuggestComponent,
+    source_key: Hashable | None = None,
+):
     search_text = action.cursor
-    is_prog_props = search_text.startswith(":")
-    prefix = ":" if is_prog_props else ""
+    is_closing_tag = search_text.startswith("/")
+    if is_closing_tag:
+        search_text = search_text[1:]
+
+    candidates = [
+        name
+        for name, type_ in _cached_search(get_script, source_key, search_text)
+        if type_ in _COMPONENT_TYPES
+    ]
+    candidates.extend(_with_prefix(_SORTED_ELEMENTS, search_text))
 
-    if is_prog_props:
+    if is_closing_tag:
+        return [CompletionItem(label=x, insert_text=f"{x}>") for x in candidates]
+    return [CompletionItem(label=x, insert_text=f"{x}></{x}>") for x in candidates]
+
+
+def _suggest_from_liku(component: str, search_text: str) -> list[str]:
+    return list(_with_prefix(_SORTED_PROPS[component], search_text))
+
+
+def _suggest_from_custom_component(
+    get_script: Callable[[], Script],
+    component: str,
+    search_text: str,
+    source_key: Hashable | None = None,
+):
+    names: list[str] = []
+
+    for params in _signature_params(get_script, source_key, component):
+        names.extend(name for name in params if name and name.startswith(search_text))
+    return names
+
+
+def suggest_props(
+    get_script: Callable[[], Script],
+    action: SuggestProps,
+    source_key: Hashable | None = None,
+):
+    search_text = action.cursor
+    if search_text.startswith(":"):
         search_text = search_text[1:]
 
-    completions = _suggest_from_liku(
-        action.component, search_text
-    ) or _suggest_from_custom_component(script, action.component, search_text)
-
-    return list(
-        map(
-            lambda x: CompletionItem(
-                label=f"{x}=",
-                insert_text=f'{x}=""',
-            ),
-            completions,
+    # Props of liku's own elements are known up front, jedi is only needed for
+    # the signatures of custom components.
+    if action.component in liku_elements:
+        completions = _suggest_from_liku(action.component, search_text)
+    else:
+        completions = _suggest_from_custom_component(
+            get_script, action.component, search_text, source_key
         )
-    )
+
+    return [CompletionItem(label=f"{x}=", insert_text=f'{x}=""') for x in completions]
 
 
 # module, class, instance, function, param, path, keyword, property and statement
@@ -116,21 +306,18 @@ CompletionItemKindMap = {
 }
 
 
-def suggest_python(script: Script, action: SuggestPython):
+def suggest_python(
+    get_script: Callable[[], Script],
+    action: SuggestPython,
+    source_key: Hashable | None = None,
+):
     search_text = action.cursor
     # Is there a way we can avoid this?
-    completions = script.complete_search(search_text, all_scopes=True)
-    completions_unique = set(map(lambda c: (c.name, c.type), completions))
-
-    return sorted(
-        list(
-            map(
-                lambda x: CompletionItem(
-                    label=x[0],
-                    kind=CompletionItemKindMap.get(x[1]),
-                ),
-                completions_unique,
-            )
-        ),
-        key=lambda x: x.label,
-    )
+    completions = _cached_search(get_script, source_key, search_text, all_scopes=True)
+    # Sort the plain (name, type) keys, not the CompletionItems built from them.
+    completions_unique = sorted(dict.fromkeys(completions))
+
+    return [
+        CompletionItem(label=name, kind=CompletionItemKindMap.get(type_))
+        for name, type_ in completions_unique
+    ]
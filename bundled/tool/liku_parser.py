@@ -1,15 +1,19 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from collections.abc import Iterator
 from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
+from itertools import accumulate
 import re
 from lsprotocol.types import Position
 from pygls.workspace.text_document import TextDocument
 
 STRING_CHARS = "'\""
 BRACKET_CHARS = "<>"
-TEMPLATE_RE = re.compile(r"{{(.*)}}")
-INCOMPLETE_TEMPLATE_RE = re.compile(r"{{(.*)")
-PROPS_RE = re.compile(r"""(:?)\w+=(["'])\w*\2""")
-INCOMLETE_PROG_PROPS_RE = re.compile(r""":\w+=["'](.*)""")
+# Characters that can change the tokenizer state while inside an ident.
+IDENT_SPECIALS_RE = re.compile(r"""[<>{}"'= \n]""")
+WORD_RE = re.compile(r"\w*")
 
 
 class TokenType(Enum):
@@ -29,23 +33,33 @@ class ParseState(Enum):
     TEMPLATE = 4
 
 
-@dataclass
+# Looking up enum members goes through the enum metaclass, which is far slower
+# than reading a module global, so the hot loops compare against these.
+_NONE = ParseState.NONE
+_STRING = ParseState.STRING
+_IDENT = ParseState.IDENT
+_END = ParseState.END
+_TEMPLATE = ParseState.TEMPLATE
+_BRACKET = TokenType.BRACKET
+
+
+@dataclass(frozen=True, slots=True)
 class SuggestProps:
     component: str
     cursor: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class SuggestComponent:
     cursor: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class SuggestPython:
     cursor: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Token:
     type: TokenType
     value: str
@@ -64,156 +78,295 @@ class Token:
 LSPAction = SuggestProps | SuggestComponent | SuggestPython | None
 
 
+# Keyed on the source itself: pygls keeps the same str object until the next
+# change, and str caches its hash, so a hit costs next to nothing.
+@lru_cache(maxsize=8)
+def _line_starts(source: str) -> tuple[int, ...]:
+    return tuple(accumulate(map(len, source.splitlines(True)), initial=0))
+
+
+def _offset_to_line_col(line_starts: tuple[int, ...], offset: int) -> tuple[int, int]:
+    line = bisect_right(line_starts, offset) - 1
+    return line, offset - line_starts[line]
+
+
+def _position_to_offset(line_starts: tuple[int, ...], position: Position) -> int:
+    if position.line >= len(line_starts) - 1:
+        return line_starts[-1]
+
+    line_start = line_starts[position.line]
+    line_length = line_starts[position.line + 1] - line_start
+    return line_start + min(position.character, line_length)
+
+
 class Tokenizer:
-    def __init__(
-        self, document: TextDocument, position: Position, cursor_position: Position
-    ):
+    def __init__(self, document: TextDocument, offset: int, end_offset: int):
         self.document = document
-        self.position = position
-        self.max_position = cursor_position
+        # Scan on offsets into the source, positions are only computed for
+        # the tokens that are returned.
+        self._src = document.source
+        self._line_starts = _line_starts(self._src)
+        self._end_off = end_offset
+        # Offset the next token is scanned from. Set after every token as well:
+        # whether it ended on its own rather than by hitting the cursor, and
+        # the offset past the last character read.
+        self.offset = offset
+        self.complete = False
+        self.read_end = offset
 
     def __iter__(self):
         return self
 
     def __next__(self) -> Token:
-        start_line = self.position.line
-        start_col = self.position.character
+        src = self._src
+        end_off = self._end_off
+        off = start = self.offset
 
         buf = ""
         templ_stack = 0
-        state = ParseState.NONE
-
-        while self.position.line < len(self.document.lines) and state != ParseState.END:
-            if self.position >= self.max_position:
-                state = ParseState.END
-                continue
-
-            current_line = self.document.lines[self.position.line]
-
-            if (
-                self.position.character >= len(current_line)
-                or current_line[self.position.character] == "\n"
-            ):
-                self.position.line += 1
-                self.position.character = 0
+        state = _NONE
+        # `name=` followed by a quoted value, tracked while scanning so the
+        # token can be classified without matching it against a regex.
+        eq_index = -1
+        props_quote = ""
+        props_closed = False
+        # Last character added to buf, so `{{` / `}}` can be spotted without
+        # calling buf.endswith() on every character.
+        prev_char = ""
+        last_read = off
+
+        while off < end_off and state != _END:
+            if state == _IDENT:
+                # Nothing but the special characters matter here, so take
+                # everything up to the next one in one go.
+                match = IDENT_SPECIALS_RE.search(src, off, end_off)
+                next_off = match.start() if match else end_off
+                if next_off > off:
+                    buf += src[off:next_off]
+                    prev_char = buf[-1]
+                    off = next_off
+                    continue
+
+            last_read = off
+            current_char = src[off]
+            if current_char == "\n":
+                off += 1
                 if buf:
-                    state = ParseState.END
+                    state = _END
                 else:
-                    start_line = self.position.line
-                    start_col = 0
+                    start = off
                 continue
 
-            current_char = current_line[self.position.character]
-            if buf and current_char in BRACKET_CHARS and state != ParseState.STRING:
-                state = ParseState.END
+            if buf and current_char in BRACKET_CHARS and state != _STRING:
+                state = _END
                 continue
 
             buf += current_char
-            if state != ParseState.STRING:
+            opens_template = current_char == "{" and prev_char == "{"
+            closes_template = current_char == "}" and prev_char == "}"
+            prev_char = current_char
+            if current_char == "=" and eq_index == -1 and state != _STRING:
+                eq_index = len(buf) - 1
+
+            if state != _STRING:
                 if current_char in BRACKET_CHARS:
-                    state = ParseState.END
+                    state = _END
                 else:
-                    state = ParseState.IDENT
+                    state = _IDENT
 
-                if buf == "{{":
-                    state = ParseState.TEMPLATE
+                if opens_template and len(buf) == 2:
+                    state = _TEMPLATE
 
-            if state == ParseState.TEMPLATE:
-                if buf.endswith("{{"):
+            if state == _TEMPLATE:
+                if opens_template:
                     templ_stack += 1
 
-                if buf.endswith("}}"):
+                if closes_template:
                     templ_stack -= 1
                     if templ_stack == 0:
-                        state = ParseState.END
+                        state = _END
 
             if current_char in STRING_CHARS:
-                if state == ParseState.STRING:
-                    state = ParseState.END
+                if state == _STRING:
+                    state = _END
+                    props_closed = current_char == props_quote
                 else:
-                    state = ParseState.STRING
+                    state = _STRING
+                    if eq_index != -1 and eq_index == len(buf) - 2:
+                        props_quote = current_char
 
             if current_char == " " and state not in (
-                ParseState.STRING,
-                ParseState.TEMPLATE,
+                _STRING,
+                _TEMPLATE,
             ):
-                state = ParseState.END
+                state = _END
 
             # HACK: This is to ensure that {{ x }} is an ident in itself
             #       + 1 because it'll add + 1 so reset back to start of {
-            if len(buf) > 2 and buf.endswith("{{"):
-                self.position.character -= 2
+            if opens_template and len(buf) > 2:
+                off -= 2
                 buf = buf[:-2]
-                state = ParseState.END
+                state = _END
+
+            if state != _NONE:
+                off += 1
 
-            if state != ParseState.NONE:
-                self.position.character += 1
+        self.offset = off
+        self.complete = state is _END
+        self.read_end = last_read + 1
 
         # NOTE: buf includes the ending space!!
         if buf == "":
             raise StopIteration()
 
+        start_line, start_col = _offset_to_line_col(self._line_starts, start)
+
         if buf in ("<", ">"):
             return Token(TokenType.BRACKET, buf, start_line, start_col)
 
-        if result := PROPS_RE.match(buf):
-            if result.group(1) == ":":
+        if props_closed and _is_props(buf, eq_index):
+            if buf[0] == ":":
                 return Token(TokenType.PROG_PROPS, buf, start_line, start_col)
             return Token(TokenType.PROPS, buf, start_line, start_col)
 
-        if result := TEMPLATE_RE.match(buf):
-            return Token(TokenType.TEMPLATE, buf, start_line, start_col)
-
-        if result := INCOMPLETE_TEMPLATE_RE.match(buf):
+        if buf.startswith("{{"):
+            if buf.find("}}", 2) != -1:
+                return Token(TokenType.TEMPLATE, buf, start_line, start_col)
             return Token(TokenType.INCOMPLETE_TEMPLATE, buf, start_line, start_col)
 
         return Token(TokenType.IDENT, buf, start_line, start_col)
 
 
-def find_liku_areas(html_func: str, document: TextDocument):
-    html_start_re = re.compile(rf"=? *{html_func} *\(")
-    start = Position(0, 0)
-    end = Position(0, 0)
+def _is_props(buf: str, eq_index: int) -> bool:
+    # `(:)name="value"` with a word-character name and value, the closing quote
+    # is the last character of a closed props token.
+    name_start = 1 if buf[0] == ":" else 0
+    return (
+        eq_index > name_start
+        and WORD_RE.fullmatch(buf, name_start, eq_index) is not None
+        and WORD_RE.fullmatch(buf, eq_index + 2, len(buf) - 1) is not None
+    )
+
+
+def _enclosing_area(html_func: str, source: str, offset: int) -> int | None:
+    # The area around `offset` opens at the last `"""` before it, as long as
+    # that directly follows `html(`, and closes at the next `"""`.
+    quote = source.rfind('"""', 0, offset)
+    while quote > 0 and source[quote - 1] == '"':
+        quote -= 1
+    if quote == -1:
+        return None
 
-    while True:
-        # Find the html func `html(`
-        start = Position(end.line + 1, 0)
-        while start.line < len(document.lines):
-            if html_start_re.search(document.lines[start.line]):
-                break
+    call_end = quote
+    while call_end > 0 and source[call_end - 1].isspace():
+        call_end -= 1
+    if call_end == 0 or source[call_end - 1] != "(":
+        return None
 
-            start.line += 1
-        else:
-            return
-
-        # Find the opening multistring
-        while True:
-            idx = document.lines[start.line].find('"""')
-            if idx != -1:
-                start.character = idx + len('"""')
-                break
-
-            start.line += 1
-
-        end = Position(start.line, 0)
-        while end.line < len(document.lines):
-            line = document.lines[end.line]
-            if start.line == end.line:
-                line = line[start.character :]
-
-            idx = line.find('"""')
-            if idx != -1:
-                end.character = idx
-                # Offset if inline
-                if start.line == end.line:
-                    end.character += start.character
-                break
-
-            end.line += 1
+    call_end -= 1
+    while call_end > 0 and source[call_end - 1] == " ":
+        call_end -= 1
+    if not source.endswith(html_func, 0, call_end):
+        return None
+
+    start = quote + len('"""')
+    end = source.find('"""', start)
+    if end == -1 or offset > end:
+        return None
+
+    return start
+
+
+def _prog_props_tail(value: str) -> str | None:
+    if not value.startswith(":"):
+        return None
+
+    # `:name="...` with a word-character name.
+    eq = value.find("=")
+    if (
+        eq < 2
+        or WORD_RE.fullmatch(value, 1, eq) is None
+        or value[eq + 1 : eq + 2] not in ("'", '"')
+    ):
+        return None
+
+    return value[eq + 2 :]
+
+
+@dataclass(frozen=True, slots=True)
+class _CachedToken:
+    token: Token
+    # Offset past the last character the token depends on
+    read_end: int
+    # Offset the tokenizer carries on from after this token
+    next_off: int
+
+
+# The complete tokens of the last scan per document uri, as (html_func, source,
+# area start offset, its (line, column), tokens). Typing only changes the source
+# around the cursor, so the tokens before it can be taken from here instead of
+# scanning again.
+_TOKEN_CACHE: OrderedDict[
+    str, tuple[str, str, int, tuple[int, int], list[_CachedToken]]
+] = OrderedDict()
+_TOKEN_CACHE_SIZE = 8
+
+
+def _reusable_tokens(
+    html_func: str, document: TextDocument, start: int, end: int
+) -> list[_CachedToken]:
+    cached = _TOKEN_CACHE.get(document.uri)
+    if cached is None:
+        return []
+
+    cached_html_func, cached_source, cached_start, cached_line_col, tokens = cached
+    if cached_html_func != html_func or cached_start != start:
+        return []
+
+    # Token positions follow from the area start position and the text after
+    # it, an edit above the area can move the start to another line.
+    source = document.source
+    if _offset_to_line_col(_line_starts(source), start) != cached_line_col:
+        return []
+
+    # Tokens which only read text before the cursor, then the longest run of
+    # those whose text is unchanged since they were scanned.
+    lo, hi = 0, bisect_right(tokens, end, key=lambda t: t.read_end)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        read_end = tokens[mid - 1].read_end
+        if source[start:read_end] == cached_source[start:read_end]:
+            lo = mid
         else:
-            return
+            hi = mid - 1
 
-        yield (start, end)
+    return tokens[:lo]
+
+
+def _tokenize(
+    html_func: str, document: TextDocument, start: int, end: int
+) -> Iterator[Token]:
+    tokens = _reusable_tokens(html_func, document, start, end)
+    for cached in tokens:
+        yield cached.token
+
+    tokenizer = Tokenizer(document, tokens[-1].next_off if tokens else start, end)
+    for token in tokenizer:
+        if tokenizer.complete:
+            tokens.append(_CachedToken(token, tokenizer.read_end, tokenizer.offset))
+        yield token
+
+    source = document.source
+    _TOKEN_CACHE[document.uri] = (
+        html_func,
+        source,
+        start,
+        _offset_to_line_col(_line_starts(source), start),
+        tokens,
+    )
+    _TOKEN_CACHE.move_to_end(document.uri)
+    if len(_TOKEN_CACHE) > _TOKEN_CACHE_SIZE:
+        _TOKEN_CACHE.popitem(last=False)
 
 
 def action_at_cursor(
@@ -221,33 +374,26 @@ def action_at_cursor(
     position: Position,
     html_func: str,
 ) -> LSPAction:
-    start_position = None
-    for start, end in find_liku_areas(html_func, document):
-        if start > position:
-            break
-
-        if position >= start and position <= end:
-            start_position = start
-
-    if not start_position:
+    source = document.source
+    offset = _position_to_offset(_line_starts(source), position)
+    start = _enclosing_area(html_func, source, offset)
+    if start is None:
         return None
 
-    tokenizer = Tokenizer(document, start_position, position)
+    tokenizer = _tokenize(html_func, document, start, offset)
 
     is_inside_tag = False
     component_token: Token | None = None
     last_token: Token | None = None
 
     for token in tokenizer:
-        if is_inside_tag and token.type == TokenType.BRACKET and token.value == ">":
+        if is_inside_tag and token.type is _BRACKET and token.value == ">":
             is_inside_tag = False
             component_token = None
-        elif (
-            not is_inside_tag and token.type == TokenType.BRACKET and token.value == "<"
-        ):
+        elif not is_inside_tag and token.type is _BRACKET and token.value == "<":
             is_inside_tag = True
 
-        if token.type == TokenType.BRACKET and token.value == "<":
+        if token.type is _BRACKET and token.value == "<":
             try:
                 # This must be the component name
                 component_token = next(tokenizer)
@@ -270,8 +416,9 @@ def action_at_cursor(
 
     if last_token and component_token:
         if last_token.type == TokenType.IDENT:
-            if match := INCOMLETE_PROG_PROPS_RE.match(last_token.value):
-                return SuggestPython(match.group(1) or "")
+            tail = _prog_props_tail(last_token.value)
+            if tail is not None:
+                return SuggestPython(tail)
 
             return SuggestProps(
                 component_token.value.strip(),
@@ -4,10 +4,14 @@
 
 from __future__ import annotations
 
+import asyncio
+import functools
 import json
 import os
 import pathlib
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 # **********************************************************
@@ -37,12 +41,14 @@ from pygls import server, uris, workspace
 from jedi import Script
 from jedi.api.classes import Name
 from liku_parser import (
+    LSPAction,
     SuggestComponent,
     SuggestProps,
     SuggestPython,
     action_at_cursor,
 )
 from liku_commands import (
+    forget_document,
     suggest_components,
     suggest_props,
     suggest_python,
@@ -51,11 +57,20 @@ from liku_commands import (
 
 WORKSPACE_SETTINGS = {}
 GLOBAL_SETTINGS = {}
+# (normalized root, key) for the keys of WORKSPACE_SETTINGS, longest first so
+# the first root a path starts with is the innermost workspace. Rebuilt by
+# _update_workspace_settings.
+_WORKSPACE_ROOTS: list[tuple[str, str]] = []
 
 MAX_WORKERS = 5
 LSP_SERVER = server.LanguageServer(
     name="liku-server", version="v0.0.1", max_workers=MAX_WORKERS
 )
+# Runs the jedi side of completion, only so the event loop keeps reading
+# messages (and applying edits) meanwhile. Jedi is not safe to use from several
+# threads, a single worker keeps it and the caches built on it (_SCRIPTS and
+# the jedi results in liku_commands) on one thread, in submission order.
+_READ_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="liku-read")
 
 
 # **********************************************************
@@ -78,32 +93,142 @@ TOOL_DISPLAY = "Liku"
 # Autocompletion feature
 # **********************************************************
 
+# Completion requests for a document that arrive within this many seconds of
+# each other are coalesced, only the last one does the work.
+COMPLETION_DEBOUNCE = 0.02
+_COMPLETION_REQUESTS: dict[str, int] = {}
+
+# Latest (version, Script) per document uri, jedi parses the whole source when
+# a Script is created.
+_SCRIPTS: OrderedDict[str, tuple[int, Script]] = OrderedDict()
+_SCRIPTS_SIZE = 32
+
+
+@functools.lru_cache(maxsize=256)
+def _action_at_cursor_cached(
+    uri: str, _version: int, line: int, character: int, html_func: str
+) -> LSPAction:
+    # `_version` is only part of the key, so an edit to the document misses.
+    document = LSP_SERVER.workspace.get_text_document(uri)
+    return action_at_cursor(document, lsp.Position(line, character), html_func)
+
+
+def _get_action(
+    document: workspace.TextDocument, position: lsp.Position, html_func: str
+) -> LSPAction:
+    if document.version is None:
+        return action_at_cursor(document, position, html_func)
+
+    return _action_at_cursor_cached(
+        document.uri, document.version, position.line, position.character, html_func
+    )
+
+
+def _get_script(uri: str, version: int | None, source: str, path: str | None) -> Script:
+    if version is None:
+        return Script(source, path=path)
+
+    cached = _SCRIPTS.get(uri)
+    if cached and cached[0] == version:
+        _SCRIPTS.move_to_end(uri)
+        return cached[1]
+
+    script = Script(source, path=path)
+    _SCRIPTS[uri] = (version, script)
+    _SCRIPTS.move_to_end(uri)
+    if len(_SCRIPTS) > _SCRIPTS_SIZE:
+        _SCRIPTS.popitem(last=False)
+    return script
+
+
+def _forget_document(uri: str) -> None:
+    # Runs in _READ_POOL, after whatever jedi work was queued before it.
+    _SCRIPTS.pop(uri, None)
+    forget_document(uri)
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CHANGE)
+def did_change(_params: lsp.DidChangeTextDocumentParams) -> None:
+    """LSP handler for textDocument/didChange notification."""
+    # Entries of older versions can never be hit again.
+    _action_at_cursor_cached.cache_clear()
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CLOSE)
+def did_close(params: lsp.DidCloseTextDocumentParams) -> None:
+    """LSP handler for textDocument/didClose notification."""
+    _action_at_cursor_cached.cache_clear()
+    _COMPLETION_REQUESTS.pop(params.text_document.uri, None)
+    _READ_POOL.submit(_forget_document, params.text_document.uri)
+
 
 @LSP_SERVER.feature(
     lsp.TEXT_DOCUMENT_COMPLETION,
     lsp.CompletionOptions(trigger_characters=["<", "/"]),
 )
-def completion(params: lsp.CompletionParams):
+async def completion(params: lsp.CompletionParams):
+    uri = params.text_document.uri
+    request_id = _COMPLETION_REQUESTS[uri] = _COMPLETION_REQUESTS.get(uri, 0) + 1
+
+    await asyncio.sleep(COMPLETION_DEBOUNCE)
+    if _COMPLETION_REQUESTS.get(uri) != request_id:
+        # A newer completion request for this document came in meanwhile.
+        return []
+
+    return await _complete(params, request_id)
+
+
+async def _complete(params: lsp.CompletionParams, request_id: int):
     document: workspace.TextDocument = LSP_SERVER.workspace.get_text_document(
         params.text_document.uri
     )
     setting = _get_settings_by_document(document)
     html_func = setting.get("htmlFunction", "html")
 
-    log_to_output(str(document.lines))
-    log_to_output(str(params.position))
-    action = action_at_cursor(document, params.position, html_func)
-    log_to_output(f"Action received: {repr(action)}")
+    log_debug("Completion requested at %s in %s", params.position, document.uri)
+    action = _get_action(document, params.position, html_func)
+    log_debug("Action received: %r", action)
     if not action:
         return []
 
-    script = Script(document.source)
+    # The document may be edited while the pool works, so hand it a snapshot.
+    return await asyncio.get_running_loop().run_in_executor(
+        _READ_POOL,
+        _suggest,
+        request_id,
+        action,
+        document.uri,
+        document.version,
+        document.source,
+        document.path,
+    )
+
+
+def _suggest(
+    request_id: int,
+    action: LSPAction,
+    uri: str,
+    version: int | None,
+    source: str,
+    path: str | None,
+):
+    if _COMPLETION_REQUESTS.get(uri) != request_id:
+        # Superseded while it waited for the jedi work queued before it.
+        return []
+
+    # Only built once a suggestion actually needs jedi.
+    get_script = functools.partial(_get_script, uri, version, source, path)
+    # Version bumps on every edit, so it is enough to key jedi results on.
+    source_key = None
+    if version is not None:
+        source_key = (uri, version)
+
     if isinstance(action, SuggestComponent):
-        return suggest_components(script, action)
+        return suggest_components(get_script, action, source_key)
     elif isinstance(action, SuggestProps):
-        return suggest_props(script, action)
+        return suggest_props(get_script, action, source_key)
     elif isinstance(action, SuggestPython):
-        return suggest_python(script, action)
+        return suggest_python(get_script, action, source_key)
 
     return []
 
@@ -120,6 +245,8 @@ def initialize(params: lsp.InitializeParams) -> None:
     log_to_output(f"sys.path used to run Server:\r\n   {paths}")
 
     GLOBAL_SETTINGS.update(**params.initialization_options.get("globalSettings", {}))
+    _get_global_defaults.cache_clear()
+    _get_settings_by_directory.cache_clear()
 
     settings = params.initialization_options["settings"]
     _update_workspace_settings(settings)
@@ -131,6 +258,8 @@ def initialize(params: lsp.InitializeParams) -> None:
     )
 
 
+# Derived from GLOBAL_SETTINGS, initialize clears it on updates.
+@functools.lru_cache(maxsize=1)
 def _get_global_defaults():
     return {
         "path": GLOBAL_SETTINGS.get("path", []),
@@ -148,89 +277,122 @@ def _update_workspace_settings(settings):
         WORKSPACE_SETTINGS[key] = {
             "cwd": key,
             "workspaceFS": key,
-            "workspace": uris.from_fs_path(key),
+            "workspace": _from_fs_path(key),
             **_get_global_defaults(),
         }
-        return
+    else:
+        for setting in settings:
+            key = uris.to_fs_path(setting["workspace"])
+            WORKSPACE_SETTINGS[key] = {
+                "cwd": key,
+                **setting,
+                "workspaceFS": key,
+            }
+
+    _WORKSPACE_ROOTS[:] = sorted(
+        ((_normalize_path(key), key) for key in WORKSPACE_SETTINGS),
+        key=lambda root: len(root[0]),
+        reverse=True,
+    )
 
-    for setting in settings:
-        key = uris.to_fs_path(setting["workspace"])
-        WORKSPACE_SETTINGS[key] = {
-            "cwd": key,
-            **setting,
-            "workspaceFS": key,
-        }
 
+@functools.lru_cache(maxsize=256)
+def _from_fs_path(path: str) -> str | None:
+    return uris.from_fs_path(path)
 
-def _get_settings_by_path(file_path: pathlib.Path):
-    workspaces = {s["workspaceFS"] for s in WORKSPACE_SETTINGS.values()}
 
-    while file_path != file_path.parent:
-        str_file_path = str(file_path)
-        if str_file_path in workspaces:
-            return WORKSPACE_SETTINGS[str_file_path]
-        file_path = file_path.parent
+def _normalize_path(path: str) -> str:
+    return os.path.normcase(os.path.normpath(path))
 
-    setting_values = list(WORKSPACE_SETTINGS.values())
-    return setting_values[0]
 
+def _match_workspace(path: str) -> str | None:
+    """Returns the settings key of the innermost workspace containing `path`."""
+    path = _normalize_path(path)
+    for root, key in _WORKSPACE_ROOTS:
+        if path == root or path.startswith(root + os.sep):
+            return key
 
-def _get_document_key(document: workspace.Document):
-    if WORKSPACE_SETTINGS:
-        document_workspace = pathlib.Path(document.path)
-        workspaces = {s["workspaceFS"] for s in WORKSPACE_SETTINGS.values()}
+    return None
 
-        # Find workspace settings for the given file.
-        while document_workspace != document_workspace.parent:
-            if str(document_workspace) in workspaces:
-                return str(document_workspace)
-            document_workspace = document_workspace.parent
 
-    return None
+def _get_settings_by_path(file_path: str | os.PathLike[str]):
+    key = _match_workspace(os.fspath(file_path))
+    if key is not None:
+        return WORKSPACE_SETTINGS[key]
+
+    return next(iter(WORKSPACE_SETTINGS.values()))
+
+
+def _get_document_key(document: workspace.Document):
+    # Find workspace settings for the given file.
+    return _match_workspace(document.path)
 
 
 def _get_settings_by_document(document: workspace.Document | None):
     if document is None or document.path is None:
-        return list(WORKSPACE_SETTINGS.values())[0]
+        return next(iter(WORKSPACE_SETTINGS.values()))
 
     key = _get_document_key(document)
     if key is None:
         # This is either a non-workspace file or there is no workspace.
-        key = os.fspath(pathlib.Path(document.path).parent)
-        return {
-            "cwd": key,
-            "workspaceFS": key,
-            "workspace": uris.from_fs_path(key),
-            **_get_global_defaults(),
-        }
+        return _get_settings_by_directory(os.path.dirname(document.path))
 
     return WORKSPACE_SETTINGS[str(key)]
 
 
+# Settings of files outside every workspace, clients keep asking for the same
+# few directories.
+@functools.lru_cache(maxsize=32)
+def _get_settings_by_directory(key: str):
+    return {
+        "cwd": key,
+        "workspaceFS": key,
+        "workspace": _from_fs_path(key),
+        **_get_global_defaults(),
+    }
+
+
 # *****************************************************
 # Logging and notification.
 # *****************************************************
+# Most verbose message type log_debug sends, raise to lsp.MessageType.Log to
+# trace every completion request.
+LOG_LEVEL = lsp.MessageType.Warning
+
+# The client sets this when it starts the server, it does not change after.
+_SHOW_NOTIFICATION = os.getenv("LS_SHOW_NOTIFICATION", "off")
+_NOTIFY_ERROR = _SHOW_NOTIFICATION in ("onError", "onWarning", "always")
+_NOTIFY_WARNING = _SHOW_NOTIFICATION in ("onWarning", "always")
+_NOTIFY_ALWAYS = _SHOW_NOTIFICATION == "always"
+
+
 def log_to_output(
     message: str, msg_type: lsp.MessageType = lsp.MessageType.Log
 ) -> None:
     LSP_SERVER.show_message_log(message, msg_type)
 
 
+def log_debug(message: str, *args: object) -> None:
+    """Logs `message % args`, which is only formatted when LOG_LEVEL allows."""
+    if LOG_LEVEL >= lsp.MessageType.Log:
+        LSP_SERVER.show_message_log(message % args, lsp.MessageType.Log)
+
+
 def log_error(message: str) -> None:
     LSP_SERVER.show_message_log(message, lsp.MessageType.Error)
-    if os.getenv("LS_SHOW_NOTIFICATION", "off") in ["onError", "onWarning", "always"]:
+    if _NOTIFY_ERROR:
         LSP_SERVER.show_message(message, lsp.MessageType.Error)
 
 
 def log_warning(message: str) -> None:
     LSP_SERVER.show_message_log(message, lsp.MessageType.Warning)
-    if os.getenv("LS_SHOW_NOTIFICATION", "off") in ["onWarning", "always"]:
+    if _NOTIFY_WARNING:
         LSP_SERVER.show_message(message, lsp.MessageType.Warning)
 
 
 def log_always(message: str) -> None:
     LSP_SERVER.show_message_log(message, lsp.MessageType.Info)
-    if os.getenv("LS_SHOW_NOTIFICATION", "off") in ["always"]:
+    if _NOTIFY_ALWAYS:
         LSP_SERVER.show_message(message, lsp.MessageType.Info)
 
 
@@ -23,6 +23,10 @@ def _install_bundle(session: nox.Session) -> None:
     )
 
 
+def _generate_liku_mapping(session: nox.Session) -> None:
+    session.run("python", "./tools/gen_liku_mapping.py")
+
+
 def _check_files(names: List[str]) -> None:
     root_dir = pathlib.Path(__file__).parent
     for name in names:
@@ -100,6 +104,7 @@ def _setup_template_environment(session: nox.Session) -> None:
         "./src/test/python_tests/requirements.in",
     )
     _install_bundle(session)
+    _generate_liku_mapping(session)
 
 
 @nox.session()
@@ -0,0 +1,102 @@
+"""
+Test for tokenizing liku templates.
+"""
+
+import sys
+
+import pytest
+from hamcrest import assert_that, is_
+
+from .lsp_test_client import constants
+
+sys.path[:0] = [
+    str(constants.PROJECT_ROOT / "bundled" / "libs"),
+    str(constants.PROJECT_ROOT / "bundled" / "tool"),
+]
+
+# pylint: disable=wrong-import-position,import-error
+from lsprotocol.types import Position  # noqa: E402
+from pygls.workspace.text_document import TextDocument  # noqa: E402
+
+import liku_parser  # noqa: E402
+from liku_parser import SuggestProps, SuggestPython, TokenType  # noqa: E402
+
+
+PREFIX = 'x = 1\nhtml("""'
+
+
+def _document(body: str, prefix: str = PREFIX) -> TextDocument:
+    return TextDocument("file:///sample.py", prefix + body + '\n""")\n')
+
+
+def _cursor_after(body: str) -> Position:
+    return Position(1, len('html("""') + len(body))
+
+
+def _token_types(body: str) -> list[TokenType]:
+    tokenizer = liku_parser.Tokenizer(
+        _document(body), len(PREFIX), len(PREFIX) + len(body)
+    )
+    return [token.type for token in tokenizer]
+
+
+@pytest.mark.parametrize(
+    "body, expected",
+    [
+        ('x="1"', TokenType.PROPS),
+        (':x="1"', TokenType.PROG_PROPS),
+        ('{{x="1"', TokenType.INCOMPLETE_TEMPLATE),
+        ('{{bx=""', TokenType.INCOMPLETE_TEMPLATE),
+        ('}}x="}"', TokenType.IDENT),
+        ("):y=' '", TokenType.IDENT),
+        ('x="a b"', TokenType.IDENT),
+    ],
+)
+def test_props_classification(body, expected):
+    """Only `(:)name="value"` of word characters is classified as props."""
+    assert_that(_token_types(body), is_([expected]))
+
+
+@pytest.mark.parametrize(
+    "body, expected",
+    [
+        ('<div>{{x="1"', SuggestPython('x="1"')),
+        ('<div>{{bx=""', SuggestPython('bx=""')),
+        ('<div x="1" ', SuggestProps("div", "")),
+        ('<div :x="v', SuggestPython("v")),
+        ('<div :data-x="v', SuggestProps("div", ':data-x="v')),
+    ],
+)
+def test_action_after_props_like_text(body, expected):
+    """Props-like text inside a template is still completed as python."""
+    actual = liku_parser.action_at_cursor(_document(body), _cursor_after(body), "html")
+    assert_that(actual, is_(expected))
+
+
+def test_reused_tokens_follow_edits_above_area():
+    """Tokens taken from the last scan get the positions of a fresh scan."""
+    body = '<div a="b" c'
+    for prefix in (PREFIX, 'x =\n1\nhtml("""'):
+        # Same area start offset, but the area moves down a line.
+        start = len(prefix)
+        tokens = list(
+            liku_parser._tokenize("html", _document(body, prefix), start, start + 10)
+        )
+        assert_that({token.line for token in tokens}, is_({prefix.count("\n")}))
+
+
+@pytest.mark.parametrize(
+    "source, offset, expected",
+    [
+        ('x = html("""<div>""")', 12, 12),
+        ('x = html("""<div>""")', 17, 12),
+        ('x = html("""<div>""")', 11, None),
+        ('x = html("""<div>""")', 20, None),
+        ('x = html(\n    """<div>""")', 18, 17),
+        ('x = f("""<div>""")', 12, None),
+        ('x = html("""<div>', 12, None),
+    ],
+)
+def test_enclosing_area(source, offset, expected):
+    """The area around the cursor opens right after `html(` and is closed."""
+    assert_that(liku_parser._enclosing_area("html", source, offset), is_(expected))
@@ -0,0 +1,42 @@
+"""Generates bundled/tool/_liku_tag_props.py from the bundled liku.
+
+The server reads prop names from the generated module instead of reflecting
+on liku's h() overloads at startup. Rerun this whenever liku is upgraded,
+`nox -s setup` and `nox -s build_package` already do.
+"""
+
+import pathlib
+import pprint
+import sys
+
+ROOT = pathlib.Path(__file__).parent.parent
+TOOL_DIR = ROOT / "bundled" / "tool"
+OUTPUT = TOOL_DIR / "_liku_tag_props.py"
+
+sys.path[:0] = [str(ROOT / "bundled" / "libs"), str(TOOL_DIR)]
+
+# pylint: disable=wrong-import-position,import-error
+import liku_commands  # noqa: E402
+
+HEADER = """# This file is generated by tools/gen_liku_mapping.py, do not edit.
+# Prop names of every liku element, valid for the liku.elements matching
+# LIKU_ELEMENTS_DIGEST.
+"""
+
+
+def main() -> None:
+    props = {
+        tag: tuple(sorted(hints))
+        for tag, hints in liku_commands._build_mapping().items()
+    }
+    OUTPUT.write_text(
+        HEADER
+        + f"LIKU_ELEMENTS_DIGEST = {liku_commands._liku_elements_digest()!r}\n"
+        + f"PROPS: dict[str, tuple[str, ...]] = {pprint.pformat(props)}\n",
+        encoding="utf-8",
+    )
+    print(f"Wrote {len(props)} elements to {OUTPUT}")
+
+
+if __name__ == "__main__":
+    main()